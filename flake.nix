@@ -44,6 +44,7 @@
           rustToolchain
           pkgs.qemu_kvm
           pkgs.tmux # needed for integration test
+          pkgs.sccache # used by tests/conftest.py, caches in ~/.cache/sccache-vmsh
           (pkgs.python3.withPackages (ps: [
             ps.pytest
             ps.pytest-xdist
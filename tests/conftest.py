@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
 
 import contextlib
+import hashlib
 import os
+import selectors
+import shutil
+import signal
 import subprocess
 import sys
 import threading
+from collections import deque
 from pathlib import Path
-from queue import Queue
 from shlex import quote
-from typing import Any, List, Type, Union, Callable, Optional
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Type,
+)
 
 import pytest
 from qemu import QemuVm, VmImage, spawn_qemu
@@ -18,14 +31,75 @@ from root import PROJECT_ROOT, TEST_ROOT
 sys.path.append(str(TEST_ROOT.parent))
 
 
+def rust_sources() -> Iterator[Path]:
+    for path in ["Cargo.toml", "Cargo.lock", "build.rs"]:
+        yield PROJECT_ROOT.joinpath(path)
+    for top in ["src", "examples"]:
+        for root, dirs, files in os.walk(PROJECT_ROOT.joinpath(top)):
+            # skip build outputs of nested crates
+            dirs[:] = [d for d in dirs if d != "target"]
+            for f in files:
+                yield Path(root).joinpath(f)
+
+
+def sources_hash(kerneldir: str) -> str:
+    h = hashlib.blake2b(kerneldir.encode())
+    for source in sorted(rust_sources()):
+        try:
+            content = source.read_bytes()
+        except FileNotFoundError:
+            continue
+        h.update(str(source.relative_to(PROJECT_ROOT)).encode() + b"\0")
+        h.update(content)
+    return h.hexdigest()
+
+
+def cargo(args: List[str], env: Dict[str, str]) -> None:
+    cmd = ["cargo"] + args
+    # If the lock file is up-to-date and all dependencies were fetched by an
+    # earlier build, skip the registry update. Compile errors must not trigger
+    # a second build, so only this check decides about --frozen.
+    frozen = subprocess.run(
+        ["cargo", "metadata", "--frozen", "--format-version", "1"],
+        cwd=PROJECT_ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    if frozen.returncode == 0:
+        cmd.append("--frozen")
+    subprocess.run(cmd, cwd=PROJECT_ROOT, env=env, check=True)
+
+
 def cargo_build() -> Path:
+    """
+    Skips cargo entirely if the sources did not change since the last build,
+    as even a no-op cargo build has to scan the whole dependency graph.
+    """
+    target_dir = PROJECT_ROOT.joinpath("target", "debug")
+    stamp = target_dir.joinpath(".vmsh_src_hash")
+    artifacts = [
+        target_dir.joinpath("vmsh"),
+        target_dir.joinpath("examples/test_ioctls"),
+    ]
+    kerneldir = str(notos_image().kerneldir)
+    if all(a.exists() for a in artifacts) and stamp.exists():
+        if stamp.read_text() == sources_hash(kerneldir):
+            return target_dir
     env = os.environ.copy()
-    env["KERNELDIR"] = str(notos_image().kerneldir)
-    subprocess.run(["cargo", "build"], cwd=PROJECT_ROOT, env=env, check=True)
-    subprocess.run(
-        ["cargo", "build", "--examples"], cwd=PROJECT_ROOT, env=env, check=True
-    )
-    return PROJECT_ROOT.joinpath("target", "debug")
+    env["KERNELDIR"] = kerneldir
+    if "RUSTC_WRAPPER" not in env and shutil.which("sccache"):
+        # Cache compiler output across test sessions. CI should keep this
+        # directory between runs.
+        env["RUSTC_WRAPPER"] = "sccache"
+        env.setdefault(
+            "SCCACHE_DIR", str(Path.home().joinpath(".cache", "sccache-vmsh"))
+        )
+    cargo(["build"], env)
+    cargo(["build", "--examples"], env)
+    # build.rs generates files in src/, so hash after the build
+    stamp.write_text(sources_hash(kerneldir))
+    return target_dir
 
 
 _build_artifacts: Optional[Path] = None
@@ -38,47 +112,70 @@ def build_artifacts() -> Path:
     return _build_artifacts
 
 
-EOF = 1
-
-
 class VmshPopen(subprocess.Popen):
     def process_stdout(self) -> None:
-        self.lines: Queue[Union[str, int]] = Queue()
-        threading.Thread(target=self.print_stdout).start()
-        threading.Thread(target=self.print_stderr).start()
+        self.lines: Deque[str] = deque()
+        self.lines_eof = False
+        self.lines_cond = threading.Condition()
+        # Popen closes its own pipe ends in __exit__, so the reader thread
+        # works on duplicates that stay valid until vmsh closes its end.
+        fds = []
+        for stdio in [self.stdout, self.stderr]:
+            assert stdio is not None
+            fds.append(os.dup(stdio.fileno()))
+        threading.Thread(target=self.print_stdio_with_prefix, args=(fds,)).start()
 
     def terminate(self) -> None:
-        subprocess.run(["pkill", "--parent", str(self.pid)])
+        if self.returncode is not None:
+            return
+        # We cannot rely on killing sudo, but vmsh drops privileges to our user.
+        # spawn_vmsh_command starts sudo in a new session, so the process group
+        # id is our pid and a single killpg reaches vmsh.
+        # PermissionError: only sudo is left in the group and still runs as root.
+        try:
+            os.killpg(self.pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            return
+        try:
+            self.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(self.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
 
     def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
-        # we cannot kill sudo, but we can stop vmsh as it drops privileges to our user
         self.terminate()
         super().__exit__(exc_type, exc_value, traceback)
 
-    def print_stdio_with_prefix(self, stdio: Any) -> None:
-        buf = ""
-        while True:
-            assert stdio is not None
-            res = stdio.read(1)
-
-            if len(res) > 0:
-                if res == "\n":
-                    print(f"vmsh[{self.pid}] {buf}")
-                    self.lines.put(buf)
-                    buf = ""
-                else:
-                    buf += res
-            else:
-                if buf != "":
-                    print(f"vmsh[{self.pid}] {buf}", flush=True)
-                self.lines.put(EOF)
-                return
-
-    def print_stderr(self) -> None:
-        self.print_stdio_with_prefix(self.stderr)
-
-    def print_stdout(self) -> None:
-        self.print_stdio_with_prefix(self.stdout)
+    def print_stdio_with_prefix(self, fds: List[int]) -> None:
+        """
+        Multiplexes stdout and stderr of vmsh in a single thread
+        """
+        buffers = {fd: b"" for fd in fds}
+        with selectors.DefaultSelector() as sel:
+            for fd in fds:
+                sel.register(fd, selectors.EVENT_READ)
+            while sel.get_map():
+                for key, _ in sel.select():
+                    fd = key.fd
+                    data = os.read(fd, 4096)
+                    if data:
+                        *lines, buffers[fd] = (buffers[fd] + data).split(b"\n")
+                    else:
+                        sel.unregister(fd)
+                        os.close(fd)
+                        rest = buffers.pop(fd)
+                        lines = [rest] if rest else []
+                    decoded = [raw.decode("utf-8", "replace") for raw in lines]
+                    for line in decoded:
+                        print(f"vmsh[{self.pid}] {line}")
+                    with self.lines_cond:
+                        self.lines.extend(decoded)
+                        self.lines_cond.notify_all()
+        with self.lines_cond:
+            self.lines_eof = True
+            self.lines_cond.notify_all()
 
     def wait_until_line(self, tag: str, condition: Callable[[str], bool]) -> None:
         """
@@ -87,14 +184,16 @@ class VmshPopen(subprocess.Popen):
         @param tag: printable, human readable tag
         """
         print(f"wait for '{tag}'...")
-        while True:
-            l = self.lines.get()
-
-            if l == EOF:
-                raise Exception("reach end of stdout output before process finished")
-
-            if condition(str(l)):
-                return
+        with self.lines_cond:
+            while True:
+                self.lines_cond.wait_for(lambda: self.lines or self.lines_eof)
+                while self.lines:
+                    if condition(self.lines.popleft()):
+                        return
+                if self.lines_eof:
+                    raise Exception(
+                        "reach end of stdout output before process finished"
+                    )
 
 
 def spawn_vmsh_command(args: List[str], cargo_executable: str = "vmsh") -> VmshPopen:
@@ -125,7 +224,12 @@ def spawn_vmsh_command(args: List[str], cargo_executable: str = "vmsh") -> VmshP
         cmd_quoted,
     ]
     print("$ " + " ".join(map(quote, cmd)))
-    p = VmshPopen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    p = VmshPopen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True,
+    )
     p.process_stdout()
     return p
 
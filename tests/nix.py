@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 
+import dataclasses
 import functools
 import json
+import os
 import shutil
 import subprocess
 from contextlib import contextmanager
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from typing import Any, Iterator
+from typing import IO, Any, Iterator
 
 from qemu import VmImage
 from root import PROJECT_ROOT
@@ -29,17 +31,36 @@ def nix_build(what: str) -> Any:
     return json.loads(result.stdout)
 
 
+def copy_image(src: str, dst: IO[bytes]) -> None:
+    with open(src, "rb") as f:
+        remaining = os.fstat(f.fileno()).st_size
+        try:
+            # in-kernel copy, CoW filesystems can share extents instead
+            while remaining > 0:
+                copied = os.copy_file_range(f.fileno(), dst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            return
+        except OSError:
+            # e.g. EXDEV on kernels that refuse cross-filesystem copies
+            f.seek(0)
+            dst.seek(0)
+            dst.truncate()
+        shutil.copyfileobj(f, dst)
+
+
 @contextmanager
 def busybox_image() -> Iterator[Path]:
     image = nix_build(".#busybox-image")
     out = image[0]["outputs"]["out"]
     with NamedTemporaryFile() as n:
-        with open(out, "rb") as f:
-            shutil.copyfileobj(f, n)
+        copy_image(out, n)
         n.flush()
         yield Path(n.name)
 
 
+@functools.lru_cache(maxsize=1)
 def notos_image() -> VmImage:
     data = nix_build(".#not-os-image.json")
     with open(data[0]["outputs"]["out"]) as f:
@@ -58,7 +79,10 @@ def notos_image_custom_kernel() -> VmImage:
     This is useful for debugging.
     Make sure to use the same kernel version in your kernel as used in notos
     """
-    image = notos_image()
-    image.kerneldir = PROJECT_ROOT.joinpath("..", "linux")
-    image.kernel = image.kerneldir.joinpath("arch", "x86", "boot")
-    return image
+    kerneldir = PROJECT_ROOT.joinpath("..", "linux")
+    # notos_image() is cached, don't modify it in place
+    return dataclasses.replace(
+        notos_image(),
+        kerneldir=kerneldir,
+        kernel=kerneldir.joinpath("arch", "x86", "boot"),
+    )
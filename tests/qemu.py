@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
+import errno
 import json
 import os
 import re
+import selectors
+import signal
 import socket
 import subprocess
 import time
@@ -12,7 +15,7 @@ from pathlib import Path
 from queue import Queue
 from shlex import quote
 from tempfile import TemporaryDirectory
-from typing import Any, Dict, Iterator, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Set
 
 from root import TEST_ROOT, PROJECT_ROOT
 
@@ -90,10 +93,67 @@ def is_port_open(ip: str, port: int, wait_response: bool = False) -> bool:
         return False
 
 
+def has_ssh_banner(ip: str, port: int, timeout: float = 1) -> bool:
+    """
+    qemu's user networking accepts connections on forwarded ports before
+    sshd in the guest is listening, so wait for the server's banner instead.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setblocking(False)
+        if s.connect_ex((ip, port)) not in (0, errno.EINPROGRESS):
+            return False
+        with selectors.DefaultSelector() as sel:
+            sel.register(s, selectors.EVENT_READ)
+            if not sel.select(timeout):
+                return False
+        try:
+            return s.recv(4) == b"SSH-"
+        except OSError:
+            return False
+
+
 @contextmanager
-def connect_qmp(path: Path) -> Iterator[QmpSession]:
-    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    sock.connect(str(path))
+def accept_qmp(
+    listener: socket.socket, qemu_pid: int, timeout: float = 60
+) -> Iterator[QmpSession]:
+    """
+    Wait until qemu connects to our qmp socket.
+    Instead of polling we wake up either on the incoming connection or when
+    qemu exits (via pidfd). Python < 3.9 has no os.pidfd_open, there we fall
+    back to checking every 100ms whether qemu is still alive.
+    """
+    deadline = time.monotonic() + timeout
+    pidfd: Optional[int] = None
+    if hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(qemu_pid)
+        except ProcessLookupError:
+            raise Exception("qemu vm was terminated")
+    try:
+        with selectors.DefaultSelector() as sel:
+            sel.register(listener, selectors.EVENT_READ)
+            if pidfd is not None:
+                sel.register(pidfd, selectors.EVENT_READ)
+            sock: Optional[socket.socket] = None
+            while sock is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Exception("timeout while waiting for qemu to connect to qmp")
+                if pidfd is None:
+                    remaining = min(remaining, 0.1)
+                ready = {key.fileobj for key, _ in sel.select(remaining)}
+                if pidfd in ready:
+                    raise Exception("qemu vm was terminated")
+                if listener in ready:
+                    sock, _ = listener.accept()
+                if sock is None and pidfd is None:
+                    try:
+                        os.kill(qemu_pid, 0)
+                    except ProcessLookupError:
+                        raise Exception("qemu vm was terminated")
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
 
     try:
         yield QmpSession(sock)
@@ -124,11 +184,18 @@ def get_ssh_port(session: QmpSession) -> int:
 
 
 class QemuVm:
-    def __init__(self, qmp_session: QmpSession, tmux_session: str, pid: int) -> None:
+    def __init__(
+        self,
+        qmp_session: QmpSession,
+        tmux_session: str,
+        pid: int,
+        ssh_control_path: Path,
+    ) -> None:
         self.qmp_session = qmp_session
         self.tmux_session = tmux_session
         self.pid = pid
         self.ssh_port = get_ssh_port(qmp_session)
+        self.ssh_control_path = ssh_control_path
 
     def events(self) -> Iterator[Dict[str, Any]]:
         return self.qmp_session.events()
@@ -138,6 +205,11 @@ class QemuVm:
         Block until ssh port is accessible
         """
         print(f"wait for ssh on {self.ssh_port}")
+        delay = 0.01
+        while not has_ssh_banner("127.0.0.1", self.ssh_port):
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        # sshd answers, but might still refuse logins for a moment
         while True:
             if (
                 self.ssh_cmd(
@@ -148,6 +220,37 @@ class QemuVm:
                 break
             time.sleep(0.1)
 
+    def ssh_command(self, argv: List[str]) -> List[str]:
+        """
+        @return: ssh command line that runs `argv` in the vm
+        """
+        cmd = " ".join(map(quote, argv))
+        key_path = TEST_ROOT.joinpath("..", "nix", "ssh_key")
+        key_path.chmod(0o400)
+        return [
+            "ssh",
+            "-i",
+            str(key_path),
+            "-p",
+            str(self.ssh_port),
+            "-oBatchMode=yes",
+            "-oStrictHostKeyChecking=no",
+            "-oConnectTimeout=5",
+            "-oUserKnownHostsFile=/dev/null",
+            "-oGSSAPIAuthentication=no",
+            # prefer AES-GCM (AES-NI) but keep the default list as fallback
+            "-oCiphers=^aes128-gcm@openssh.com",
+            # never allocate a pty
+            "-T",
+            # the first connection becomes the master, all later commands
+            # are multiplexed over it and skip the handshake
+            "-oControlMaster=auto",
+            f"-oControlPath={self.ssh_control_path}",
+            "-oControlPersist=60s",
+            "root@127.0.1",
+            cmd,
+        ]
+
     def ssh_cmd(
         self,
         argv: List[str],
@@ -160,29 +263,84 @@ class QemuVm:
         @return: CompletedProcess.stderr/stdout contains output of `cmd` which
         is run in the vm via ssh.
         """
-        cmd = " ".join(map(quote, argv))
-        key_path = TEST_ROOT.joinpath("..", "nix", "ssh_key")
-        key_path.chmod(0o400)
         return subprocess.run(
-            [
-                "ssh",
-                "-i",
-                str(key_path),
-                "-p",
-                str(self.ssh_port),
-                "-oBatchMode=yes",
-                "-oStrictHostKeyChecking=no",
-                "-oConnectTimeout=5",
-                "-oUserKnownHostsFile=/dev/null",
-                "root@127.0.1",
-                cmd,
-            ],
+            self.ssh_command(argv),
             stdout=stdout,
             stderr=stderr,
             check=check,
             text=text,
         )
 
+    def ssh_stream(self, argv: List[str], timeout: float = 10) -> Optional[str]:
+        """
+        Run a (long-running) command in the vm and return its first line of
+        output as soon as it is printed, without waiting for the command to
+        exit. Useful with filters such as `dmesg -w | grep ...`. Killing ssh
+        does not stop the remote side, so bound it as well, e.g. with
+        `timeout 10 dmesg -w | grep -m1 ...`.
+        @return: None if no line was printed within `timeout` seconds
+        """
+        deadline = time.monotonic() + timeout
+        with subprocess.Popen(self.ssh_command(argv), stdout=subprocess.PIPE) as proc:
+            assert proc.stdout is not None
+            fd = proc.stdout.fileno()
+            buf = b""
+            try:
+                with selectors.DefaultSelector() as sel:
+                    sel.register(fd, selectors.EVENT_READ)
+                    while b"\n" not in buf:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0 or not sel.select(remaining):
+                            return None
+                        data = os.read(fd, 4096)
+                        if not data:
+                            return None
+                        buf += data
+            finally:
+                proc.kill()
+            return buf.split(b"\n", 1)[0].decode("utf-8", "replace")
+
+    def close_ssh_master(self) -> None:
+        """
+        Stop the ssh master connection started by `ssh_cmd`, if any
+        """
+        if not self.ssh_control_path.exists():
+            return
+        subprocess.run(
+            [
+                "ssh",
+                f"-oControlPath={self.ssh_control_path}",
+                "-O",
+                "exit",
+                "root@127.0.1",
+            ],
+            stderr=subprocess.DEVNULL,
+        )
+
+    def ssh_batch(
+        self, argvs: List[List[str]], check: bool = True
+    ) -> List[subprocess.CompletedProcess]:
+        """
+        Run multiple commands sequentially over a single ssh connection.
+        @return: one CompletedProcess per command in `argvs`; stdout is split
+        per command, stderr is passed through.
+        """
+        marker = "---vmsh-batch-exit-status:"
+        script = "".join(
+            f"{' '.join(map(quote, argv))}; echo \"{marker}$?\"; " for argv in argvs
+        )
+        res = self.ssh_cmd(["sh", "-c", script], check=False)
+        parts = re.split(f"{re.escape(marker)}(\\d+)\n", res.stdout)
+        if len(parts) != 2 * len(argvs) + 1:
+            raise subprocess.CalledProcessError(res.returncode, res.args, res.stdout)
+        results = []
+        for argv, stdout, returncode in zip(argvs, parts[0::2], parts[1::2]):
+            proc = subprocess.CompletedProcess(argv, int(returncode), stdout)
+            if check:
+                proc.check_returncode()
+            results.append(proc)
+        return results
+
     def regs(self) -> Dict[str, int]:
         """
         Get cpu register:
@@ -216,16 +374,29 @@ class QemuVm:
         return self.qmp_session.send(cmd, args)
 
 
-def qemu_command(image: VmImage, qmp_socket: Path, ssh_port: int = 0) -> List:
+def qemu_command(
+    image: VmImage, qmp_socket: Path, ssh_port: int = 0, qmp_server: bool = True
+) -> List:
     """
     @image VM image to boot
     @qmp_socket unixsocket path of the QEMU qmp control socket
     @ssh_port host port bound to vm guest port (0 means dynamic port)
+    @qmp_server if False, qemu connects to a socket listening on `qmp_socket`
+    instead of creating it
     """
     params = " ".join(image.kernel_params)
+    qmp = f"unix:{str(qmp_socket)}"
+    if qmp_server:
+        qmp += ",server,nowait"
     return [
         "qemu-system-x86_64",
         "-enable-kvm",
+        # vmsh only walks 4-level page tables
+        "-cpu",
+        "host,la57=off",
+        # only the devices listed below, no vga, default nic, etc.
+        "-nodefaults",
+        "-no-user-config",
         "-name",
         "test-os",
         "-m",
@@ -250,7 +421,7 @@ def qemu_command(image: VmImage, qmp_socket: Path, ssh_port: int = 0) -> List:
         "-device",
         "virtconsole,chardev=char0,nr=0",
         "-append",
-        f"console=hvc0 {params} quiet panic=-1",
+        f"console=hvc0 {params} quiet panic=-1 tsc=reliable mitigations=off",
         "-netdev",
         f"user,id=n1,hostfwd=tcp:127.0.0.1:{ssh_port}-:22",
         "-device",
@@ -258,21 +429,70 @@ def qemu_command(image: VmImage, qmp_socket: Path, ssh_port: int = 0) -> List:
         "-virtfs",
         f"local,path={PROJECT_ROOT},security_model=none,mount_tag=vmsh",
         "-qmp",
-        f"unix:{str(qmp_socket)},server,nowait",
+        qmp,
         "-no-reboot",
         "-device",
         "virtio-rng-pci",
     ]
 
 
+def worker_cpus() -> Optional[List[int]]:
+    """
+    Disjoint block of our CPUs for the current pytest-xdist worker, so VMs of
+    concurrent workers don't compete for the same cores and caches.
+    Leftover CPUs go to the first workers. If a worker would get less than two
+    CPUs, qemu's vcpu, main loop and io threads would be serialized on one
+    core, so we don't pin at all in that case.
+    """
+    worker = os.environ.get("PYTEST_XDIST_WORKER")
+    count = os.environ.get("PYTEST_XDIST_WORKER_COUNT")
+    if worker is None or count is None:
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    workers = int(count)
+    per_worker, leftover = divmod(len(cpus), workers)
+    if per_worker < 2:
+        return None
+    idx = int(worker.lstrip("gw"))
+    start = idx * per_worker + min(idx, leftover)
+    end = start + per_worker + (1 if idx < leftover else 0)
+    return cpus[start:end]
+
+
+def pin_threads(pid: int, cpus: List[int]) -> None:
+    # sched_setaffinity only applies to a single thread. Threads spawned later
+    # inherit it from their creator, so repeat until no unpinned thread is left.
+    pinned: Set[int] = set()
+    while True:
+        try:
+            tasks = os.listdir(f"/proc/{pid}/task")
+        except FileNotFoundError:
+            # qemu already exited, accept_qmp/QmpSession will report it
+            return
+        tids = {int(tid) for tid in tasks} - pinned
+        if not tids:
+            return
+        for tid in tids:
+            try:
+                os.sched_setaffinity(tid, cpus)
+            except ProcessLookupError:
+                pass
+        pinned |= tids
+
+
 @contextmanager
 def spawn_qemu(image: VmImage, extra_args: List[str] = []) -> Iterator[QemuVm]:
     with TemporaryDirectory() as tempdir:
         qmp_socket = Path(tempdir).joinpath("qmp.sock")
-        cmd = qemu_command(image, qmp_socket)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(str(qmp_socket))
+        listener.listen(1)
+        cmd = qemu_command(image, qmp_socket, qmp_server=False)
         cmd += extra_args
 
-        tmux_session = f"pytest-{os.getpid()}"
+        # unique across xdist workers and across VMs spawned by the same worker
+        worker = os.environ.get("PYTEST_XDIST_WORKER", "master")
+        tmux_session = f"pytest-{worker}-{Path(tempdir).name}"
         tmux = [
             "tmux",
             "-L",
@@ -283,6 +503,7 @@ def spawn_qemu(image: VmImage, extra_args: List[str] = []) -> Iterator[QemuVm]:
         ]
         print("$ " + " ".join(map(quote, tmux)))
         subprocess.run(tmux, check=True)
+        tmux_pidfd: Optional[int] = None
         try:
             proc = subprocess.run(
                 [
@@ -292,19 +513,43 @@ def spawn_qemu(image: VmImage, extra_args: List[str] = []) -> Iterator[QemuVm]:
                     "list-panes",
                     "-a",
                     "-F",
-                    "#{pane_pid}",
+                    "#{pane_pid} #{pid}",
                 ],
                 stdout=subprocess.PIPE,
                 check=True,
             )
-            qemu_pid = int(proc.stdout)
-            while not qmp_socket.exists():
+            qemu_pid, tmux_pid = map(int, proc.stdout.split())
+            if hasattr(os, "pidfd_open"):
+                # a pidfd keeps referring to the server even after it exited,
+                # so we cannot signal an unrelated process that reused its pid
                 try:
-                    os.kill(qemu_pid, 0)
-                    time.sleep(0.1)
+                    tmux_pidfd = os.pidfd_open(tmux_pid)
                 except ProcessLookupError:
-                    raise Exception("qemu vm was terminated")
-            with connect_qmp(qmp_socket) as session:
-                yield QemuVm(session, tmux_session, qemu_pid)
+                    pass
+            with accept_qmp(listener, qemu_pid) as session:
+                vm = QemuVm(
+                    session,
+                    tmux_session,
+                    qemu_pid,
+                    Path(tempdir).joinpath("ssh.sock"),
+                )
+                cpus = worker_cpus()
+                if cpus is not None:
+                    pin_threads(qemu_pid, cpus)
+                try:
+                    yield vm
+                finally:
+                    vm.close_ssh_master()
         finally:
-            subprocess.run(["tmux", "-L", tmux_session, "kill-server"])
+            listener.close()
+            if tmux_pidfd is None:
+                subprocess.run(["tmux", "-L", tmux_session, "kill-server"])
+            else:
+                # same as `tmux kill-server`, without forking a tmux client.
+                # The server exits on its own once qemu (its only pane) died.
+                try:
+                    signal.pidfd_send_signal(tmux_pidfd, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+                finally:
+                    os.close(tmux_pidfd)
@@ -27,15 +27,25 @@ def test_attach(helpers: conftest.Helpers) -> None:
         )
 
         with vmsh:
+            mounted = None
             try:
                 vmsh.wait_until_line(
                     "block device driver started",
                     lambda l: "block device driver started" in l,
                 )
+                # only transfer the line we are looking for
+                mounted = vm.ssh_stream(
+                    [
+                        "sh",
+                        "-c",
+                        "timeout 10 dmesg -w | grep -m1 -F 'ext4 filesystem being mounted at /tmp/'",
+                    ],
+                    timeout=10,
+                )
             finally:
-                res = vm.ssh_cmd(["dmesg"], check=False)
-                print("stdout:\n", res.stdout)
-            assert res.returncode == 0
+                if mounted is None:
+                    res = vm.ssh_cmd(["dmesg"], check=False)
+                    print("stdout:\n", res.stdout)
 
             # with DeviceMmioSpace instead of KvmRunWrapper:
             # assert (
@@ -49,7 +59,7 @@ def test_attach(helpers: conftest.Helpers) -> None:
             # )
 
             # with KvmRunWrapper:
-            assert res.stdout.find("ext4 filesystem being mounted at /tmp/") > 0
+            assert mounted is not None, "ext4 filesystem was not mounted"
         try:
             os.kill(vmsh.pid, 0)
         except ProcessLookupError:
@@ -5,12 +5,5 @@ def test_inspect(helpers: conftest.Helpers) -> None:
     with helpers.spawn_qemu(helpers.notos_image()) as vm:
         vm.wait_for_ssh()
         proc = helpers.run_vmsh_command(["inspect", str(vm.pid)])
-        found = False
-        while not proc.lines.empty():
-            line = proc.lines.get()
-            if isinstance(line, int):
-                break
-            if "found kernel at" in line:
-                found = True
-                break
-        assert found, "could not find kernel"
+        # raises if vmsh finished without finding the kernel
+        proc.wait_until_line("found kernel", lambda l: "found kernel at" in l)